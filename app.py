@@ -1,16 +1,33 @@
+from typing import List
+import requests
 import streamlit as st
-import json
-import pandas as pd
-from io import StringIO
 from core import (
     PromptEnhancer,
     get_ollama_models,
-    call_ollama,
-    choose_enhancement_strategy,
+    stream_ollama,
+    warm_up_model,
     ENHANCEMENT_PATTERNS,
 )
 
 
+@st.cache_resource
+def get_enhancer() -> PromptEnhancer:
+    return PromptEnhancer()
+
+
+@st.cache_data(ttl=60)
+def list_ollama_models() -> List[str]:
+    return get_ollama_models()
+
+
+@st.cache_resource(show_spinner="Loading model...")
+def warm_up(model: str) -> bool:
+    # warm_up_model raises on failure, and Streamlit does not cache exceptions,
+    # so a model that failed to load is tried again on the next rerun
+    warm_up_model(model)
+    return True
+
+
 def main():
     st.set_page_config(
         page_title="Advanced Prompt Enhancer AI Agent (Ollama Edition)",
@@ -24,8 +41,7 @@ def main():
     )
 
     # --- INITIALIZE SESSION STATE ---
-    if "enhancer" not in st.session_state:
-        st.session_state.enhancer = PromptEnhancer()
+    st.session_state.enhancer = get_enhancer()
     if "enhanced_prompt" not in st.session_state:
         st.session_state.enhanced_prompt = ""
     if "llm_response" not in st.session_state:
@@ -37,7 +53,7 @@ def main():
     with st.sidebar:
         st.header("⚙️ Configuration")
 
-        available_models = get_ollama_models()
+        available_models = list_ollama_models()
         if available_models:
             selected_model = st.selectbox(
                 "Select an Ollama Model:",
@@ -46,6 +62,11 @@ def main():
                 key="ollama_model",
                 help="Models detected from your local Ollama instance.",
             )
+            # Load the weights now rather than on the first enhancement
+            try:
+                warm_up(selected_model)
+            except requests.exceptions.RequestException:
+                pass  # Not fatal, the model is loaded by the first request instead
         else:
             st.warning("Could not connect to Ollama. Please ensure it's running.")
             selected_model = st.text_input(
@@ -85,17 +106,18 @@ def main():
                 st.session_state.llm_response = ""  # Clear previous response
                 st.session_state.critique = "" # Clear previous critique
 
-                with st.spinner("🤖 AI agent is thinking... Choosing enhancement strategy..."):
-                    enhancement_type = choose_enhancement_strategy(user_prompt, selected_model)
-                
-                st.info(f"**Chosen Strategy:** {ENHANCEMENT_PATTERNS[enhancement_type]['name']}")
-                st.markdown(f"_{ENHANCEMENT_PATTERNS[enhancement_type]['description']}_")
-
-                with st.spinner("🧠 Enhancing prompt..."):
-                    enhanced_prompt = st.session_state.enhancer.enhance_prompt(
-                        user_prompt, enhancement_type, model=selected_model
+                with st.spinner("🤖 AI agent is thinking... Choosing and applying an enhancement strategy..."):
+                    enhancement_type, critique, enhanced_prompt = (
+                        st.session_state.enhancer.decide_and_enhance(
+                            user_prompt, selected_model
+                        )
                     )
+                    st.session_state.critique = critique
                     st.session_state.enhanced_prompt = enhanced_prompt
+                
+                meta = ENHANCEMENT_PATTERNS[enhancement_type]
+                st.info(f"**Chosen Strategy:** {meta['name']}")
+                st.markdown(f"_{meta['description']}_")
 
         if st.session_state.critique:
             with st.expander("🔍 View AI Critique", expanded=False):
@@ -107,13 +129,14 @@ def main():
             
             generate_button = st.button("🚀 Generate Response", use_container_width=True)
             if generate_button:
-                with st.spinner(f"🚀 Generating response from **{selected_model}**..."):
-                    llm_response = call_ollama(st.session_state.enhanced_prompt, selected_model)
-                    st.session_state.llm_response = llm_response
-
-        if st.session_state.llm_response:
-            st.subheader("💬 AI Response")
-            st.markdown(st.session_state.llm_response, unsafe_allow_html=True)
+                st.subheader("💬 AI Response")
+                # Render tokens as they arrive instead of waiting for the full completion
+                st.session_state.llm_response = st.write_stream(
+                    stream_ollama(st.session_state.enhanced_prompt, selected_model)
+                )
+            elif st.session_state.llm_response:
+                st.subheader("💬 AI Response")
+                st.markdown(st.session_state.llm_response, unsafe_allow_html=True)
 
 
 if __name__ == "__main__":
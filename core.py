@@ -1,9 +1,36 @@
 import re
 import json
+import string
+import asyncio
+import functools
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
-from typing import List, Dict
-import streamlit as st
+from typing import Callable, List, Dict, Iterator, Optional, Tuple, Union
+
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:  # orjson is optional, fall back to the standard library
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+# Matches the XML tags the AI rewrite strategy asks the model to wrap its output in
+_TAG_RE = re.compile(r"</?(?:critique|rewritten_prompt)>")
+
+# How long Ollama keeps the model loaded after a request, so intermittent clicks don't pay for a reload
+OLLAMA_KEEP_ALIVE = "30m"
+
+# Request bodies are pre-encoded with _json_dumps, so the content type is set by hand
+_JSON_HEADERS = {"Content-Type": "application/json"}
 
 # Enhanced prompt engineering patterns based on Anthropic's best practices
 ENHANCEMENT_PATTERNS = {
@@ -100,30 +127,59 @@ Following the pattern shown in the examples above, please process the actual tas
 }
 
 
-class PromptEnhancer:
-    def __init__(self):
-        self.enhancement_history = []
+def _split_template(template):
+    """Split a template whose only placeholder is a single {original_prompt} into (prefix, suffix)"""
+    if template is None or template.count("{original_prompt}") != 1:
+        return None
+    fields = {field for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+    if fields != {"original_prompt"} or "{{" in template or "}}" in template:
+        return None
+    return tuple(template.split("{original_prompt}"))
 
-    def enhance_prompt(self, prompt: str, enhancement_type: str, **kwargs) -> str:
-        """Enhance the prompt using the specified strategy"""
-        if enhancement_type not in ENHANCEMENT_PATTERNS:
-            return prompt
 
+def _compile_template(template) -> Callable[[str, Dict], str]:
+    """Turn a template into a function of (prompt, kwargs) that fills it in"""
+    parts = _split_template(template)
+    if parts is not None:
+        # Single-placeholder templates are filled by concatenation instead of str.format
+        prefix, suffix = parts
+        return lambda prompt, kwargs: prefix + prompt + suffix
+    return lambda prompt, kwargs: template.format(original_prompt=prompt, **kwargs)
+
+
+# Template strategies, keyed by enhancement type; ai_rewrite has no template and is handled separately
+_DISPATCH: Dict[str, Callable[[str, Dict], str]] = {
+    key: _compile_template(pattern["template"])
+    for key, pattern in ENHANCEMENT_PATTERNS.items()
+    if pattern["template"] is not None
+}
+
+
+class PromptEnhancer:
+    def __init__(self):
+        # Bounded, so a long-lived (cached) enhancer does not grow without limit
+        self.enhancement_history = deque(maxlen=1000)
+
+    def enhance_prompt(
+        self, prompt: str, enhancement_type: str, **kwargs
+    ) -> Union[str, Tuple[str, str]]:
+        """
+        Enhance the prompt using the specified strategy.
+        Returns the enhanced prompt, or a (critique, rewritten_prompt) tuple for "ai_rewrite".
+        """
         # Handle the AI rewrite strategy separately
         if enhancement_type == "ai_rewrite":
-            critique, rewritten_prompt = rewrite_prompt_with_ai(
-                prompt, kwargs.get("model", "llama3")
-            )
-            # We store the critique for display in the UI
-            st.session_state.critique = critique
-            return rewritten_prompt
+            # The caller decides where the critique goes (e.g. session state in the UI)
+            return rewrite_prompt_with_ai(prompt, kwargs.get("model", "llama3"))
 
-        pattern = ENHANCEMENT_PATTERNS[enhancement_type]
-        enhanced = pattern["template"].format(original_prompt=prompt, **kwargs)
+        fn = _DISPATCH.get(enhancement_type)
+        if fn is None:
+            return prompt
+        enhanced = fn(prompt, kwargs)
 
         self.enhancement_history.append(
             {
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": time.time_ns(),
                 "original": prompt,
                 "enhanced": enhanced,
                 "type": enhancement_type,
@@ -132,43 +188,240 @@ class PromptEnhancer:
         )
         return enhanced
 
+    def history_iso(self) -> List[Dict]:
+        """Return the enhancement history with timestamps formatted as ISO 8601 strings"""
+        return [
+            {**entry, "timestamp": datetime.fromtimestamp(entry["timestamp"] / 1e9).isoformat()}
+            for entry in self.enhancement_history
+        ]
+
+    def decide_and_enhance(self, prompt: str, model: str) -> Tuple[str, str, str]:
+        """
+        Choose a strategy and enhance the prompt, in a single LLM call where possible.
+
+        Returns (strategy, critique, enhanced_prompt). The critique is empty
+        unless the strategy is "ai_rewrite".
+        """
+        # Long prompts always get the AI rewrite, so there is nothing to decide
+        if _wc_gt(prompt, 15):
+            critique, rewritten_prompt = rewrite_prompt_with_ai(prompt, model)
+            return "ai_rewrite", critique, rewritten_prompt
+
+        output = call_ollama(
+            _DECIDE_AND_ENHANCE_TMPL.substitute(prompt=prompt, desc=_STRATEGY_DESCRIPTIONS),
+            model,
+        )
+        if _is_ollama_error(output):
+            # Same fallback as choose_enhancement_strategy, without more doomed calls
+            return "xml_structure", "", self.enhance_prompt(prompt, "xml_structure")
+
+        strategy_match = _STRATEGY_TAG_RE.search(output)
+        if strategy_match:
+            strategy = _parse_strategy(strategy_match.group(1))
+            parsed = _parse_batch_rewrite(output)
+        else:
+            # The model did not follow the batched format, fall back to separate calls
+            # with the rewrite run speculatively alongside the strategy choice
+            strategy, critique, rewritten_prompt = asyncio.run(
+                achoose_and_rewrite(prompt, model)
+            )
+            parsed = (critique, rewritten_prompt)
+
+        if strategy != "ai_rewrite":
+            return strategy, "", self.enhance_prompt(prompt, strategy)
+
+        # Short-circuit enhance_prompt, the rewrite came back with the strategy
+        if parsed is None:
+            parsed = rewrite_prompt_with_ai(prompt, model)
+        critique, rewritten_prompt = parsed
+        return strategy, critique, rewritten_prompt
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_session() -> requests.Session:
+    """
+    Shared HTTP session, so keep-alive connections to Ollama are reused across calls and reruns.
+    Transient 5xx responses from Ollama are retried with a short backoff.
+    """
+    retries = Retry(
+        total=2,
+        # A timed-out generation is not retried, or a slow prompt would wait several timeouts
+        read=0,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        # Generation requests have no side effects, so POSTs are safe to retry too
+        allowed_methods=frozenset({"GET", "POST"}),
+        # Hand the last response back so raise_for_status reports the real status
+        raise_on_status=False,
+    )
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(max_retries=retries))
+    return session
+
 
 def get_ollama_models() -> List[str]:
     """
     Get a list of available models from the Ollama API.
     """
     try:
-        response = requests.get("http://localhost:11434/api/tags", timeout=10)
+        response = get_http_session().get("http://localhost:11434/api/tags", timeout=10)
         response.raise_for_status()
-        data = response.json()
+        data = _json_loads(response.content)
         models = sorted([model.get("name", "") for model in data.get("models", [])])
         if not models:
             return ["llama3:latest"]  # Default fallback
         return models
-    except requests.exceptions.RequestException:
+    except (requests.exceptions.RequestException, ValueError):
         return []
 
 
-def call_ollama(prompt: str, model: str = "llama3") -> str:
+def warm_up_model(model: str) -> None:
+    """
+    Ask Ollama to load the model ahead of the first request.
+    Raises requests.exceptions.RequestException if Ollama could not load it.
+    """
+    response = get_http_session().post(
+        "http://localhost:11434/api/generate",
+        data=_json_dumps({"model": model, "keep_alive": OLLAMA_KEEP_ALIVE}),
+        headers=_JSON_HEADERS,
+        timeout=120,
+    )
+    response.raise_for_status()
+
+
+def _generation_timeout(prompt: str, timeout: Optional[float] = None) -> float:
+    """
+    Scale the request timeout with the prompt size unless the caller overrides it.
+    """
+    if timeout is not None:
+        return timeout
+    return min(600, 60 + len(prompt) // 100)
+
+
+def _call_ollama_impl(model: str, prompt: str, timeout: float) -> str:
+    response = get_http_session().post(
+        "http://localhost:11434/api/generate",
+        data=_json_dumps(
+            {
+                "model": model,
+                "prompt": prompt,
+                "stream": False,
+                "keep_alive": OLLAMA_KEEP_ALIVE,
+            }
+        ),
+        headers=_JSON_HEADERS,
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    data = _json_loads(response.content)
+    return data.get("response", "[No response from Ollama]").strip()
+
+
+# Errors are raised out of the implementation, so only successful completions are cached
+_call_ollama_cached = functools.lru_cache(maxsize=256)(_call_ollama_impl)
+
+
+def call_ollama(
+    prompt: str, model: str = "llama3", timeout: Optional[float] = None
+) -> str:
     """
     Call the local Ollama API to generate a completion for the given prompt.
+    Completions for a (model, prompt) pair that was already seen are served from memory.
     """
     try:
-        response = requests.post(
-            "http://localhost:11434/api/generate",
-            json={"model": model, "prompt": prompt, "stream": False},
-            timeout=90,  # Increased timeout for potentially longer generation
-        )
-        response.raise_for_status()
-        data = response.json()
-        return data.get("response", "[No response from Ollama]").strip()
+        return _call_ollama_cached(model, prompt, _generation_timeout(prompt, timeout))
     except Exception as e:
         return f"[Ollama Error: {e}]"
 
 
-def rewrite_prompt_with_ai(prompt: str, model: str) -> (str, str):
-    """Critiques and rewrites a prompt using an LLM."""
-    critique_prompt = f"""<task>
+def _is_ollama_error(output: str) -> bool:
+    """Whether output is the error string returned by call_ollama rather than a completion"""
+    return output.startswith("[Ollama Error")
+
+
+def stream_ollama(
+    prompt: str, model: str = "llama3", timeout: Optional[float] = None
+) -> Iterator[str]:
+    """
+    Call the local Ollama API and yield the completion as it is generated.
+    """
+    try:
+        with get_http_session().post(
+            "http://localhost:11434/api/generate",
+            data=_json_dumps(
+                {
+                    "model": model,
+                    "prompt": prompt,
+                    "stream": True,
+                    "keep_alive": OLLAMA_KEEP_ALIVE,
+                }
+            ),
+            headers=_JSON_HEADERS,
+            timeout=_generation_timeout(prompt, timeout),
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = _json_loads(line)
+                if "error" in chunk:
+                    yield f"[Ollama Error: {chunk['error']}]"
+                    return
+                yield chunk.get("response", "")
+    except Exception as e:
+        yield f"[Ollama Error: {e}]"
+
+
+# Worker threads for the async helpers. A module-level pool, unlike the loop's default
+# executor, is not joined by asyncio.run(), so an abandoned speculative call doesn't block it.
+_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+
+async def _run_in_executor(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(
+        _EXECUTOR, functools.partial(fn, *args)
+    )
+
+
+async def acall_ollama(
+    prompt: str, model: str = "llama3", timeout: Optional[float] = None
+) -> str:
+    """
+    Asynchronous variant of call_ollama, so independent calls can overlap.
+    It runs call_ollama in a worker thread, so it shares its session, retries and cache.
+    """
+    return await _run_in_executor(call_ollama, prompt, model, timeout)
+
+
+def _build_batch_rewrite_prompt(prompt: str) -> str:
+    return f"""<task>
+You are a world-class prompt engineering expert. You will complete two numbered tasks for the following user-provided prompt.
+
+**User Prompt:**
+`{prompt}`
+
+[1] Analyze and critique the user prompt. Identify its weaknesses based on criteria like clarity, specificity, context, constraints, and desired output format. Be specific and constructive. Provide your critique inside a <critique> XML tag.
+
+[2] Rewrite the user prompt to be a much more effective, "best-in-class" prompt, addressing all the points in your critique from [1]. The new prompt should be significantly more detailed and structured, incorporating principles like XML tagging, clear instructions, context, and examples where appropriate. Provide the new prompt inside a <rewritten_prompt> XML tag.
+
+Respond with the <critique> tag followed by the <rewritten_prompt> tag, and nothing else.
+</task>"""
+
+
+def _parse_batch_rewrite(output: str):
+    """Returns (critique, rewritten_prompt), or None if either tag is missing."""
+    critique_match = re.search(r"<critique>(.*?)</critique>", output, re.DOTALL)
+    rewritten_match = re.search(
+        r"<rewritten_prompt>(.*?)</rewritten_prompt>", output, re.DOTALL
+    )
+    if critique_match and rewritten_match:
+        return critique_match.group(1).strip(), rewritten_match.group(1).strip()
+    return None
+
+
+def _build_critique_prompt(prompt: str) -> str:
+    return f"""<task>
 You are a world-class prompt engineering expert. Your task is to analyze and critique the following user-provided prompt.
 Identify its weaknesses based on criteria like clarity, specificity, context, constraints, and desired output format.
 
@@ -178,9 +431,9 @@ Identify its weaknesses based on criteria like clarity, specificity, context, co
 Provide your critique in a <critique> XML tag. Be specific and constructive.
 </task>"""
 
-    critique = call_ollama(critique_prompt, model)
 
-    rewrite_prompt = f"""<task>
+def _build_rewrite_prompt(prompt: str, critique: str) -> str:
+    return f"""<task>
 You are a world-class prompt engineering expert. You will be given an original prompt and a critique of that prompt.
 Your task is to rewrite the original prompt to be a much more effective, "best-in-class" prompt, addressing all the points in the critique.
 The new prompt should be significantly more detailed and structured, incorporating principles like XML tagging, clear instructions, context, and examples where appropriate.
@@ -194,42 +447,71 @@ The new prompt should be significantly more detailed and structured, incorporati
 Now, provide the new, rewritten prompt inside a <rewritten_prompt> XML tag. Output only the content for the new prompt, without the XML tag itself.
 </task>"""
 
-    rewritten_prompt = call_ollama(rewrite_prompt, model)
 
+def _clean_two_step_output(critique: str, rewritten_prompt: str) -> (str, str):
     # Clean up the output to remove the XML tags if they are present
-    critique = critique.replace("<critique>", "").replace("</critique>", "").strip()
-    rewritten_prompt = (
-        rewritten_prompt.replace("<rewritten_prompt>", "")
-        .replace("</rewritten_prompt>", "")
-        .strip()
-    )
-
+    critique = _TAG_RE.sub("", critique).strip()
+    rewritten_prompt = _TAG_RE.sub("", rewritten_prompt).strip()
     return critique, rewritten_prompt
 
 
-def choose_enhancement_strategy(prompt: str, model: str) -> str:
-    """
-    Uses an LLM to choose the best enhancement strategy for a given prompt.
-    """
-    # Give the AI a strong preference for the rewrite strategy for complex prompts
-    if len(prompt.split()) > 15:
-        return "ai_rewrite"
+def rewrite_prompt_with_ai(prompt: str, model: str) -> (str, str):
+    """Critiques and rewrites a prompt using a single batched LLM call."""
+    output = call_ollama(_build_batch_rewrite_prompt(prompt), model)
+    if _is_ollama_error(output):
+        # Retrying as two more calls would only make the user wait for the same error
+        return "", output
 
-    strategy_descriptions = "\n".join(
-        [
-            f"- **{key}**: {details['name']} - {details['description']}"
-            for key, details in ENHANCEMENT_PATTERNS.items()
-        ]
+    parsed = _parse_batch_rewrite(output)
+    if parsed is not None:
+        return parsed
+
+    # The model did not follow the batched format, fall back to two separate calls
+    return _rewrite_prompt_two_step(prompt, model)
+
+
+def _rewrite_prompt_two_step(prompt: str, model: str) -> (str, str):
+    """Critiques and then rewrites a prompt using two sequential LLM calls."""
+    critique = call_ollama(_build_critique_prompt(prompt), model)
+    rewritten_prompt = call_ollama(_build_rewrite_prompt(prompt, critique), model)
+    return _clean_two_step_output(critique, rewritten_prompt)
+
+
+async def arewrite_prompt_with_ai(prompt: str, model: str) -> (str, str):
+    """Asynchronous variant of rewrite_prompt_with_ai."""
+    output = await acall_ollama(_build_batch_rewrite_prompt(prompt), model)
+    if _is_ollama_error(output):
+        return "", output
+
+    parsed = _parse_batch_rewrite(output)
+    if parsed is not None:
+        return parsed
+
+    # The rewrite depends on the critique, so these two calls stay sequential
+    critique = await acall_ollama(_build_critique_prompt(prompt), model)
+    rewritten_prompt = await acall_ollama(
+        _build_rewrite_prompt(prompt, critique), model
     )
+    return _clean_two_step_output(critique, rewritten_prompt)
+
 
-    meta_prompt = f"""<task>
+# ENHANCEMENT_PATTERNS never changes at runtime, so the strategy prompt pieces are built once
+_STRATEGY_DESCRIPTIONS = "\n".join(
+    [
+        f"- **{key}**: {details['name']} - {details['description']}"
+        for key, details in ENHANCEMENT_PATTERNS.items()
+    ]
+)
+
+_META_PROMPT_TMPL = string.Template(
+    """<task>
 You are an expert in prompt engineering. Your task is to analyze the following user prompt and choose the single best enhancement strategy from the list provided.
 
 **User Prompt:**
-\"{prompt}\"
+\"${prompt}\"
 
 **Available Enhancement Strategies:**
-{strategy_descriptions}
+${desc}
 
 **Instructions:**
 1. Read the user prompt carefully.
@@ -239,11 +521,108 @@ You are an expert in prompt engineering. Your task is to analyze the following u
 </task>
 
 Chosen strategy identifier:"""
+)
+
+# Strategy selection and the AI rewrite in one batch prompt, see PromptEnhancer.decide_and_enhance
+_DECIDE_AND_ENHANCE_TMPL = string.Template(
+    """<task>
+You are a world-class prompt engineering expert. You will complete numbered tasks for the following user-provided prompt.
+
+**User Prompt:**
+\"${prompt}\"
 
-    chosen_strategy_raw = call_ollama(meta_prompt, model).strip().lower()
+**Available Enhancement Strategies:**
+${desc}
+
+[1] Choose the single best enhancement strategy from the list above. For simple, short prompts, a template-based approach is fine. For more complex or vague prompts, `ai_rewrite` is usually the best choice. Provide ONLY the identifier of your chosen strategy (e.g., xml_structure, ai_rewrite) inside a <strategy> XML tag.
+
+Only if you chose ai_rewrite in [1], also complete these tasks:
+
+[2] Analyze and critique the user prompt. Identify its weaknesses based on criteria like clarity, specificity, context, constraints, and desired output format. Be specific and constructive. Provide your critique inside a <critique> XML tag.
+
+[3] Rewrite the user prompt to be a much more effective, "best-in-class" prompt, addressing all the points in your critique from [2]. The new prompt should be significantly more detailed and structured, incorporating principles like XML tagging, clear instructions, context, and examples where appropriate. Provide the new prompt inside a <rewritten_prompt> XML tag.
+
+Respond with the XML tags in order, and nothing else.
+</task>"""
+)
+
+_STRATEGY_TAG_RE = re.compile(r"<strategy>(.*?)</strategy>", re.DOTALL)
+
+_KEYSET = frozenset(ENHANCEMENT_PATTERNS)
 
-    for key in ENHANCEMENT_PATTERNS.keys():
-        if key in chosen_strategy_raw:
-            return key
+
+def _build_strategy_prompt(prompt: str) -> str:
+    return _META_PROMPT_TMPL.substitute(prompt=prompt, desc=_STRATEGY_DESCRIPTIONS)
+
+
+def _parse_strategy(chosen_strategy_raw: str) -> str:
+    chosen = chosen_strategy_raw.strip().lower()
+
+    # Take the first exact identifier in the output, rather than whichever key happens to be a substring
+    for tok in re.findall(r"[a-z_]+", chosen):
+        if tok in _KEYSET:
+            return tok
 
     return "xml_structure"  # Fallback
+
+
+def _wc_gt(s: str, thresh: int) -> bool:
+    """Whether s has more than thresh whitespace-separated words, stopping as soon as it does"""
+    count = 0
+    in_word = False
+    for ch in s:
+        if ch.isspace():
+            if in_word:
+                count += 1
+                in_word = False
+                if count > thresh:
+                    return True
+        else:
+            in_word = True
+    return count + in_word > thresh
+
+
+def choose_enhancement_strategy(prompt: str, model: str) -> str:
+    """
+    Uses an LLM to choose the best enhancement strategy for a given prompt.
+    """
+    # Give the AI a strong preference for the rewrite strategy for complex prompts
+    if _wc_gt(prompt, 15):
+        return "ai_rewrite"
+
+    try:
+        return _choose_impl(prompt, model)
+    except RuntimeError:
+        return "xml_structure"  # Fallback while Ollama is unavailable
+
+
+@functools.lru_cache(maxsize=256)
+def _choose_impl(prompt: str, model: str) -> str:
+    # Cached on (prompt, model) so reruns with the same input skip the LLM call
+    output = call_ollama(_build_strategy_prompt(prompt), model)
+    if _is_ollama_error(output):
+        # Raised so lru_cache doesn't keep the fallback once Ollama is back
+        raise RuntimeError(output)
+    return _parse_strategy(output)
+
+
+async def achoose_enhancement_strategy(prompt: str, model: str) -> str:
+    """Asynchronous variant of choose_enhancement_strategy."""
+    return await _run_in_executor(choose_enhancement_strategy, prompt, model)
+
+
+async def achoose_and_rewrite(prompt: str, model: str) -> Tuple[str, str, str]:
+    """
+    Choose a strategy and speculatively run the AI rewrite at the same time.
+
+    Returns (strategy, critique, rewritten_prompt). The critique and rewritten
+    prompt are empty unless the strategy is "ai_rewrite".
+    """
+    rewrite_task = asyncio.ensure_future(arewrite_prompt_with_ai(prompt, model))
+    strategy = await achoose_enhancement_strategy(prompt, model)
+    if strategy == "ai_rewrite":
+        critique, rewritten_prompt = await rewrite_task
+        return strategy, critique, rewritten_prompt
+    # Stops the rewrite from issuing further calls; a request already in flight still finishes
+    rewrite_task.cancel()
+    return strategy, "", ""
@@ -1,16 +1,24 @@
+import asyncio
+import subprocess
+import time
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 import sys
 import os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from core import PromptEnhancer, get_ollama_models, call_ollama, choose_enhancement_strategy, ENHANCEMENT_PATTERNS
+import requests
+import core
+from core import PromptEnhancer, get_ollama_models, call_ollama, choose_enhancement_strategy, rewrite_prompt_with_ai, arewrite_prompt_with_ai, acall_ollama, achoose_and_rewrite, stream_ollama, ENHANCEMENT_PATTERNS
 
 class TestPromptEnhancer(unittest.TestCase):
 
     def setUp(self):
         self.enhancer = PromptEnhancer()
+        # Memoized results from one test must not leak into the next
+        core._choose_impl.cache_clear()
+        core._call_ollama_cached.cache_clear()
 
     def test_analyze_prompt(self):
         prompt = "Please give me an example of a good prompt."
@@ -28,14 +36,79 @@ class TestPromptEnhancer(unittest.TestCase):
         self.assertIn(prompt, enhanced_prompt)
         self.assertIn("<instructions>", enhanced_prompt)
 
-    @patch('core.requests.get')
-    def test_get_ollama_models(self, mock_get):
+    @patch('core.rewrite_prompt_with_ai')
+    def test_enhance_prompt_ai_rewrite_returns_critique(self, mock_rewrite):
+        mock_rewrite.return_value = ("Too vague.", "Better prompt")
+        result = self.enhancer.enhance_prompt("test prompt", "ai_rewrite", model="llama3")
+        self.assertEqual(result, ("Too vague.", "Better prompt"))
+        mock_rewrite.assert_called_once_with("test prompt", "llama3")
+
+    def test_history_iso(self):
+        self.enhancer.enhance_prompt("test prompt", "xml_structure")
+        self.assertIsInstance(self.enhancer.enhancement_history[0]["timestamp"], int)
+        history = self.enhancer.history_iso()
+        self.assertEqual(history[0]["original"], "test prompt")
+        self.assertIn("T", history[0]["timestamp"])
+
+    @patch('core.call_ollama')
+    def test_decide_and_enhance_single_call(self, mock_call_ollama):
+        mock_call_ollama.return_value = "<strategy>ai_rewrite</strategy><critique>Too vague.</critique><rewritten_prompt>Better prompt</rewritten_prompt>"
+        result = self.enhancer.decide_and_enhance("test prompt", "llama3")
+        self.assertEqual(result, ("ai_rewrite", "Too vague.", "Better prompt"))
+        self.assertEqual(mock_call_ollama.call_count, 1)
+
+    @patch('core.call_ollama')
+    def test_decide_and_enhance_template(self, mock_call_ollama):
+        mock_call_ollama.return_value = "<strategy>xml_structure</strategy>"
+        strategy, critique, enhanced = self.enhancer.decide_and_enhance("test prompt", "llama3")
+        self.assertEqual(strategy, "xml_structure")
+        self.assertEqual(critique, "")
+        self.assertIn("<instructions>", enhanced)
+
+    @patch('core.achoose_and_rewrite', new_callable=AsyncMock)
+    @patch('core.call_ollama')
+    def test_decide_and_enhance_fallback(self, mock_call_ollama, mock_achoose_and_rewrite):
+        mock_call_ollama.return_value = "I would go with ai_rewrite."
+        mock_achoose_and_rewrite.return_value = ("ai_rewrite", "Too vague.", "Better prompt")
+        result = self.enhancer.decide_and_enhance("test prompt", "llama3")
+        self.assertEqual(result, ("ai_rewrite", "Too vague.", "Better prompt"))
+        mock_achoose_and_rewrite.assert_awaited_once_with("test prompt", "llama3")
+
+    @patch('core.achoose_and_rewrite', new_callable=AsyncMock)
+    @patch('core.call_ollama')
+    def test_decide_and_enhance_error(self, mock_call_ollama, mock_achoose_and_rewrite):
+        mock_call_ollama.return_value = "[Ollama Error: down]"
+        strategy, critique, enhanced = self.enhancer.decide_and_enhance("test prompt", "llama3")
+        self.assertEqual(strategy, "xml_structure")
+        self.assertIn("<instructions>", enhanced)
+        mock_achoose_and_rewrite.assert_not_awaited()
+
+    @patch('core.get_http_session')
+    def test_get_ollama_models(self, mock_get_http_session):
         mock_response = MagicMock()
-        mock_response.json.return_value = {"models": [{"name": "llama3:latest"}]}
-        mock_get.return_value = mock_response
+        mock_response.content = b'{"models": [{"name": "llama3:latest"}]}'
+        mock_get_http_session.return_value.get.return_value = mock_response
         models = get_ollama_models()
         self.assertEqual(models, ["llama3:latest"])
 
+    @patch('core.get_http_session')
+    def test_call_ollama_caches_successful_completions(self, mock_get_http_session):
+        mock_post = mock_get_http_session.return_value.post
+        mock_post.return_value.content = b'{"response": "Hello"}'
+        mock_post.side_effect = requests.exceptions.ConnectionError("down")
+        self.assertTrue(call_ollama("cached prompt", "llama3").startswith("[Ollama Error"))
+        mock_post.side_effect = None
+        self.assertEqual(call_ollama("cached prompt", "llama3"), "Hello")
+        self.assertEqual(call_ollama("cached prompt", "llama3"), "Hello")
+        self.assertEqual(mock_post.call_count, 2)
+
+    @patch('core.get_http_session')
+    def test_stream_ollama(self, mock_get_http_session):
+        mock_response = MagicMock()
+        mock_response.iter_lines.return_value = [b'{"response": "Hel"}', b'', b'{"response": "lo", "done": true}']
+        mock_get_http_session.return_value.post.return_value.__enter__.return_value = mock_response
+        self.assertEqual("".join(stream_ollama("test prompt", "llama3")), "Hello")
+
     @patch('core.call_ollama')
     def test_choose_enhancement_strategy(self, mock_call_ollama):
         mock_call_ollama.return_value = "xml_structure"
@@ -43,5 +116,101 @@ class TestPromptEnhancer(unittest.TestCase):
         strategy = choose_enhancement_strategy(prompt, "llama3")
         self.assertEqual(strategy, "xml_structure")
 
+    @patch('core.call_ollama')
+    def test_choose_enhancement_strategy_does_not_cache_errors(self, mock_call_ollama):
+        mock_call_ollama.return_value = "[Ollama Error: down]"
+        self.assertEqual(choose_enhancement_strategy("short prompt", "llama3"), "xml_structure")
+        mock_call_ollama.return_value = "chain_of_thought"
+        self.assertEqual(choose_enhancement_strategy("short prompt", "llama3"), "chain_of_thought")
+        self.assertEqual(choose_enhancement_strategy("short prompt", "llama3"), "chain_of_thought")
+        self.assertEqual(mock_call_ollama.call_count, 2)
+
+    @patch('core.call_ollama')
+    def test_choose_enhancement_strategy_long_prompt(self, mock_call_ollama):
+        strategy = choose_enhancement_strategy(" ".join(["word"] * 16) + "\n", "llama3")
+        self.assertEqual(strategy, "ai_rewrite")
+        mock_call_ollama.assert_not_called()
+
+    @patch('core.call_ollama')
+    def test_choose_enhancement_strategy_first_identifier_wins(self, mock_call_ollama):
+        mock_call_ollama.return_value = "xml_structure (simpler than ai_rewrite here)"
+        strategy = choose_enhancement_strategy("another test prompt", "llama3")
+        self.assertEqual(strategy, "xml_structure")
+
+    @patch('core.call_ollama')
+    def test_rewrite_prompt_with_ai_single_call(self, mock_call_ollama):
+        mock_call_ollama.return_value = "<critique>Too vague.</critique>\n<rewritten_prompt>Better prompt</rewritten_prompt>"
+        critique, rewritten = rewrite_prompt_with_ai("test prompt", "llama3")
+        self.assertEqual(critique, "Too vague.")
+        self.assertEqual(rewritten, "Better prompt")
+        self.assertEqual(mock_call_ollama.call_count, 1)
+
+    @patch('core.call_ollama')
+    def test_rewrite_prompt_with_ai_fallback(self, mock_call_ollama):
+        mock_call_ollama.side_effect = [
+            "<critique>Too vague.</critique>",
+            "<critique>Too vague.</critique>",
+            "<rewritten_prompt>Better prompt</rewritten_prompt>",
+        ]
+        critique, rewritten = rewrite_prompt_with_ai("test prompt", "llama3")
+        self.assertEqual(critique, "Too vague.")
+        self.assertEqual(rewritten, "Better prompt")
+        self.assertEqual(mock_call_ollama.call_count, 3)
+
+    @patch('core.call_ollama')
+    def test_rewrite_prompt_with_ai_error_skips_fallback(self, mock_call_ollama):
+        mock_call_ollama.return_value = "[Ollama Error: Read timed out]"
+        critique, rewritten = rewrite_prompt_with_ai("test prompt", "llama3")
+        self.assertEqual(critique, "")
+        self.assertEqual(rewritten, "[Ollama Error: Read timed out]")
+        self.assertEqual(mock_call_ollama.call_count, 1)
+
+    @patch('core.acall_ollama', new_callable=AsyncMock)
+    def test_arewrite_prompt_with_ai_error_skips_fallback(self, mock_acall_ollama):
+        mock_acall_ollama.return_value = "[Ollama Error: Read timed out]"
+        critique, rewritten = asyncio.run(arewrite_prompt_with_ai("test prompt", "llama3"))
+        self.assertEqual(rewritten, "[Ollama Error: Read timed out]")
+        self.assertEqual(mock_acall_ollama.await_count, 1)
+
+    @patch('core.call_ollama')
+    def test_acall_ollama(self, mock_call_ollama):
+        mock_call_ollama.return_value = "Hello"
+        self.assertEqual(asyncio.run(acall_ollama("test prompt", "llama3")), "Hello")
+        mock_call_ollama.assert_called_once_with("test prompt", "llama3", None)
+
+    @patch('core.arewrite_prompt_with_ai')
+    @patch('core.choose_enhancement_strategy')
+    def test_achoose_and_rewrite_cancels_unused_rewrite(self, mock_choose, mock_arewrite):
+        rewrite_cancelled = []
+
+        async def slow_rewrite(prompt, model):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                rewrite_cancelled.append(True)
+                raise
+
+        mock_arewrite.side_effect = slow_rewrite
+        mock_choose.return_value = "xml_structure"
+        start = time.monotonic()
+        result = asyncio.run(achoose_and_rewrite("test prompt", "llama3"))
+        self.assertEqual(result, ("xml_structure", "", ""))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(rewrite_cancelled, [True])
+
+    @patch('core.acall_ollama', new_callable=AsyncMock)
+    def test_achoose_and_rewrite(self, mock_acall_ollama):
+        mock_acall_ollama.return_value = "<critique>Too vague.</critique><rewritten_prompt>Better prompt</rewritten_prompt>"
+        strategy, critique, rewritten = asyncio.run(achoose_and_rewrite(" ".join(["word"] * 20), "llama3"))
+        self.assertEqual(strategy, "ai_rewrite")
+        self.assertEqual(critique, "Too vague.")
+        self.assertEqual(rewritten, "Better prompt")
+
+    def test_core_import_does_not_load_streamlit(self):
+        root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        code = "import sys, core; sys.exit('streamlit' in sys.modules)"
+        result = subprocess.run([sys.executable, "-c", code], cwd=root)
+        self.assertEqual(result.returncode, 0)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file